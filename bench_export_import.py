@@ -0,0 +1,143 @@
+"""Throughput benchmark for /admin/export and /admin/import.
+
+Seeds a local datastore stub with users, posts, comments and likes, exports
+everything through ExportPage, wipes the datastore, imports the export back
+through ImportPage and reports entities per second for each direction.
+
+Run with the App Engine SDK on the path, from the project directory:
+    python bench_export_import.py [users] [posts per user]
+"""
+import sys
+import time
+import urllib
+
+# Put the SDK's bundled libraries (webapp2, jinja2, ...) on the path
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+import webapp2
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import main
+
+
+COMMENTS_PER_POST = 3
+LIKES_PER_POST = 2
+
+# Exported lines sent to /admin/import in each request
+IMPORT_CHUNK_SIZE = 5000
+
+
+"""Start fresh, strongly consistent datastore and memcache stubs"""
+def start_stubs():
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    return bed
+
+
+"""Fill the datastore and return the number of entities written"""
+def seed(users, posts_per_user):
+    user_entities = [main.User(username="user%d" % i, password="x")
+                     for i in xrange(users)]
+    db.put(user_entities)
+
+    posts = [main.Post(parent=user, subject="Post %d" % i,
+                       entry="Benchmark post body " * 20)
+             for user in user_entities for i in xrange(posts_per_user)]
+    for i in xrange(0, len(posts), main.MAX_BATCH_SIZE):
+        db.put(posts[i:i + main.MAX_BATCH_SIZE])
+
+    children = []
+    for post in posts:
+        comments = [main.Comment(parent=post, creator="user0",
+                                 entry="Benchmark comment")
+                    for i in xrange(COMMENTS_PER_POST)]
+        db.put(comments)
+        post.comments = [str(comment.key()) for comment in comments]
+        post.likes = LIKES_PER_POST
+        children += [main.Like(parent=post, creator="user%d" % i)
+                     for i in xrange(LIKES_PER_POST)]
+    for batch in (posts, children):
+        for i in xrange(0, len(batch), main.MAX_BATCH_SIZE):
+            db.put(batch[i:i + main.MAX_BATCH_SIZE])
+
+    return len(user_entities) + len(posts) * (1 + COMMENTS_PER_POST +
+                                               LIKES_PER_POST)
+
+
+"""Export every kind through ExportPage and return the exported lines"""
+def export_all():
+    lines = []
+    params = {}
+    while True:
+        query = urllib.urlencode(params)
+        request = webapp2.Request.blank("/admin/export?" + query)
+        response = request.get_response(main.app)
+        assert response.status_int == 200, response.status
+        lines += response.body.splitlines()
+
+        kind = response.headers.get("X-Export-Kind")
+        if not kind:
+            return lines
+        params = dict(kind=kind)
+        cursor = response.headers.get("X-Export-Cursor")
+        if cursor:
+            params["cursor"] = cursor
+
+
+"""Import exported lines through ImportPage in chunks"""
+def import_all(lines):
+    for i in xrange(0, len(lines), IMPORT_CHUNK_SIZE):
+        body = "\n".join(lines[i:i + IMPORT_CHUNK_SIZE])
+        request = webapp2.Request.blank("/admin/import", POST=body)
+        response = request.get_response(main.app)
+        assert response.status_int == 200, response.body
+
+
+"""Number of entities of each exported kind in the datastore"""
+def count_kinds():
+    return dict((kind, model.all(keys_only=True).count(limit=None))
+                for kind, model in main.EXPORT_MODELS.items())
+
+
+def run(users, posts_per_user):
+    bed = start_stubs()
+    total = seed(users, posts_per_user)
+    before = count_kinds()
+
+    start = time.time()
+    lines = export_all()
+    export_seconds = time.time() - start
+    size = sum(len(line) + 1 for line in lines)
+    bed.deactivate()
+
+    # Import into an empty datastore, as when migrating to a new app
+    bed = start_stubs()
+    start = time.time()
+    import_all(lines)
+    import_seconds = time.time() - start
+    after = count_kinds()
+    bed.deactivate()
+
+    assert len(lines) == total, (len(lines), total)
+    assert before == after, (before, after)
+
+    print("Seeded %d entities, exported %.1f MB" % (total, size / 1e6))
+    print("Export: %.2fs, %.0f entities/s" % (export_seconds,
+                                              total / export_seconds))
+    print("Import: %.2fs, %.0f entities/s" % (import_seconds,
+                                              total / import_seconds))
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    run(*(args + [200, 10][len(args):]))
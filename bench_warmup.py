@@ -0,0 +1,180 @@
+"""First-request latency benchmark for the /_ah/warmup handler.
+
+Starts a fresh dev_appserver.py for every run and times the first signed in
+GET / it serves, either straight away or after a request to /_ah/warmup, the
+way App Engine warms a new instance before routing users to it.  Each run
+uses its own copy of the app and an empty datastore, or a copy of the one
+given with --storage-path, so no run benefits from an earlier one.  Cold
+runs drop the warmup inbound service from their copy of app.yaml, so the
+development server cannot warm the instance on its own.
+
+Run with the App Engine SDK installed, from the project directory:
+    python bench_warmup.py [--runs N] [--storage-path DIR] [-- ARGS]
+Arguments after -- are passed on to dev_appserver.py.
+"""
+import argparse
+import distutils.spawn
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import urllib2
+
+# Put the SDK's bundled libraries (webapp2, jinja2, ...) on the path
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+import main
+
+
+root = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds to wait for the development server to accept connections
+STARTUP_TIMEOUT = 60
+
+# Signs requests in as an administrator, which /_ah/warmup requires
+ADMIN_COOKIE = ("dev_appserver_login="
+                "test@example.com:True:185804764220139124118")
+
+# Signs requests in as the user with id 1, which need not exist to see /
+USER_COOKIE = "user_id=%s" % main.make_secure_val("1")
+
+
+"""Return a TCP port nothing is listening on"""
+def free_port():
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+"""Copy the app into directory, without the warmup inbound service in
+    app.yaml unless warmup is set"""
+def copy_app(directory, warmup):
+    shutil.copytree(root, directory,
+                    ignore=shutil.ignore_patterns(".git", "*.pyc"))
+    if warmup:
+        return
+
+    path = os.path.join(directory, "app.yaml")
+    with open(path) as f:
+        config = f.read()
+    config = config.replace("inbound_services:\n- warmup\n", "")
+    with open(path, "w") as f:
+        f.write(config)
+
+
+"""Block until the development server accepts connections on port.  Only a
+    TCP connection is made, so no request reaches the app."""
+def wait_for_port(port, server):
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("dev_appserver.py exited with %d" %
+                               server.returncode)
+        try:
+            socket.create_connection(("localhost", port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("dev_appserver.py did not start in %ds" %
+                       STARTUP_TIMEOUT)
+
+
+"""Request path with the given cookie and return the seconds taken to read
+    the whole response"""
+def timed_get(port, path, cookie):
+    request = urllib2.Request("http://localhost:%d%s" % (port, path),
+                              headers=dict(Cookie=cookie))
+    start = time.time()
+    urllib2.urlopen(request).read()
+    return time.time() - start
+
+
+"""Start a fresh development server and return the seconds taken by its
+    first signed in request to /, and by the warmup request if warmup is
+    set"""
+def run(options, warmup):
+    directory = tempfile.mkdtemp()
+    try:
+        app_dir = os.path.join(directory, "app")
+        storage_path = os.path.join(directory, "storage")
+        copy_app(app_dir, warmup)
+        if options.storage_path:
+            shutil.copytree(options.storage_path, storage_path)
+        else:
+            os.mkdir(storage_path)
+
+        port = free_port()
+        server = subprocess.Popen(
+            [options.dev_appserver,
+             "--port=%d" % port,
+             "--admin_port=%d" % free_port(),
+             "--storage_path=%s" % storage_path,
+             "--skip_sdk_update_check=yes",
+             os.path.join(app_dir, "app.yaml")] + options.args,
+            stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        try:
+            wait_for_port(port, server)
+            warmup_seconds = None
+            if warmup:
+                warmup_seconds = timed_get(port, "/_ah/warmup", ADMIN_COOKIE)
+            return timed_get(port, "/", USER_COOKIE), warmup_seconds
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(directory)
+
+
+"""Middle value of a list of numbers"""
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def benchmark():
+    parser = argparse.ArgumentParser(
+        description="Time the first request to a fresh dev_appserver.py "
+                    "with and without warmup.")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="servers started for each mode (default 3)")
+    parser.add_argument("--storage-path",
+                        help="dev_appserver storage directory to copy the "
+                             "datastore from for each run")
+    parser.add_argument("--dev-appserver",
+                        default=distutils.spawn.find_executable(
+                            "dev_appserver.py"),
+                        help="path of dev_appserver.py (default: on PATH)")
+    parser.add_argument("args", nargs="*",
+                        help="extra dev_appserver.py arguments, after --")
+    options = parser.parse_args()
+    if not options.dev_appserver:
+        parser.error("dev_appserver.py not found, use --dev-appserver")
+
+    for warmup in (False, True):
+        firsts = []
+        for i in xrange(options.runs):
+            first, warmup_seconds = run(options, warmup)
+            firsts.append(first)
+            if warmup:
+                print("warm run %d: /_ah/warmup %.0f ms, first GET / %.0f ms"
+                      % (i + 1, warmup_seconds * 1000, first * 1000))
+            else:
+                print("cold run %d: first GET / %.0f ms" % (i + 1,
+                                                            first * 1000))
+        print("%s median first GET /: %.0f ms" %
+              ("warm" if warmup else "cold", median(firsts) * 1000))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,85 @@
+"""Bundle and minify the static CSS and JavaScript used by base.html.
+
+Writes static/dist/app.<hash>.css and static/dist/app.<hash>.js, named by a
+hash of their content so they can be cached forever, and records the current
+names in assets.json for the asset_url template helper.  Run after changing
+any file listed below, before deploying.
+"""
+import hashlib
+import json
+import os
+import re
+
+
+root = os.path.dirname(os.path.abspath(__file__))
+dist_dir = os.path.join(root, "static", "dist")
+manifest_path = os.path.join(root, "assets.json")
+
+# Source files for each bundle, in the order base.html loaded them
+BUNDLES = {
+    "app.css": ["static/css/bootstrap.min.css",
+                "static/css/main.css"],
+    "app.js": ["static/js/jquery-3.1.1.min.js",
+               "static/js/bootstrap.min.js"],
+}
+
+
+"""Strip comments, except /*! license comments, and redundant whitespace
+    from CSS"""
+def minify_css(css):
+    css = re.sub(r"/\*(?!!).*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = css.replace(";}", "}")
+    return css.strip()
+
+
+"""Join JavaScript files, which are already minified.  Each file is ended
+    with a semicolon and newline so that statements cannot run together."""
+def join_js(sources):
+    return "".join(source.rstrip().rstrip(";") + ";\n" for source in sources)
+
+
+"""Read a source file relative to the repository root"""
+def read(path):
+    with open(os.path.join(root, path), "rb") as f:
+        return f.read().decode("utf-8")
+
+
+def build():
+    if not os.path.isdir(dist_dir):
+        os.makedirs(dist_dir)
+
+    manifest = {}
+    for name in sorted(BUNDLES):
+        sources = [read(path) for path in BUNDLES[name]]
+        if name.endswith(".css"):
+            content = minify_css("\n".join(sources))
+        else:
+            content = join_js(sources)
+        content = content.encode("utf-8")
+
+        # Content hash in the file name changes the URL whenever it changes
+        base, ext = os.path.splitext(name)
+        digest = hashlib.md5(content).hexdigest()[:10]
+        manifest[name] = "%s.%s%s" % (base, digest, ext)
+
+        with open(os.path.join(dist_dir, manifest[name]), "wb") as f:
+            f.write(content)
+
+    # Remove bundles left over from earlier builds
+    for filename in os.listdir(dist_dir):
+        if filename not in manifest.values():
+            os.remove(os.path.join(dist_dir, filename))
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2, separators=(",", ": "),
+                  sort_keys=True)
+        f.write("\n")
+
+    return manifest
+
+
+if __name__ == "__main__":
+    for name, filename in sorted(build().items()):
+        print("%s -> static/dist/%s" % (name, filename))
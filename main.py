@@ -7,15 +7,40 @@ import hmac
 import random
 import string
 import time
+import math
+import datetime
+import heapq
+import json
+import threading
+import collections
+import functools
+from google.appengine.api import datastore
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 
 
 # Create template directory for jinja2
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
 
+# Only check templates for changes on the development server, so production
+# instances never stat a template file after compiling it
+DEV_SERVER = os.environ.get("SERVER_SOFTWARE", "").startswith("Development")
+
 # Crate jinja environment for rendering html templates
 jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
-                               autoescape=True)
+                               autoescape=True, auto_reload=DEV_SERVER)
+
+# Content-hashed file names of the static bundles, written by build_assets.py
+with open(os.path.join(os.path.dirname(__file__), 'assets.json')) as manifest:
+    asset_manifest = json.load(manifest)
+
+
+"""Template helper returning the URL of a bundled static asset"""
+def asset_url(name):
+    return "/static/dist/%s" % asset_manifest[name]
+
+jinja_env.globals["asset_url"] = asset_url
 
 
 # - - - Datastore Kind Definitions - - - - - - - - - - - - - - - - - - -
@@ -25,6 +50,12 @@ class User(db.Model):
     username = db.StringProperty(required=True)
     password = db.StringProperty(required=True)
     email = db.StringProperty()
+    followers = db.IntegerProperty(default=0)
+    popular = db.BooleanProperty(default=False)
+    popular_following = db.ListProperty(db.Key)
+    post_count = db.IntegerProperty(default=0)
+    likes_received = db.IntegerProperty(default=0)
+    comments_received = db.IntegerProperty(default=0)
     created = db.DateTimeProperty(auto_now_add=True)
 
 
@@ -52,6 +83,27 @@ class Like(db.Model):
     created = db.DateTimeProperty(auto_now_add=True)
 
 
+# Follow kind to store that a user follows another, with the followed user as
+# parent and the follower's user id as key name
+class Follow(db.Model):
+    follower = db.IntegerProperty(required=True)
+    created = db.DateTimeProperty(auto_now_add=True)
+
+
+# Timeline kind to store a blog post on a user's home timeline, with the user
+# as parent.  Key names sort newest first and encode the post key, so a
+# timeline is read with a keys only query.
+class TimelineEntry(db.Model):
+    author = db.IntegerProperty(required=True)
+    created = db.DateTimeProperty(auto_now_add=True)
+
+
+# Feed kind to store precomputed, ordered lists of blog post keys
+class Feed(db.Model):
+    posts = db.ListProperty(db.Key)
+    updated = db.DateTimeProperty(auto_now=True)
+
+
 # - - - Registration Input Verification - - - - - - - - - - - - - - - - - - -
 
 """Compare username passed to regular expression"""
@@ -115,11 +167,681 @@ def val_pw(name, pw, h):
         return True
 
 
+# - - - Instance Cache - - - - - - - - - - - - - - - - - - -
+
+# Bounds for the per-instance entity cache
+ENTITY_CACHE_ENTRIES = 2000
+ENTITY_CACHE_BYTES = 16 * 1024 * 1024
+ENTITY_CACHE_TTL = 60
+
+# Seconds a cached entity is served without checking its version again.
+# Writes on this instance drop their cached copies at once; writes on other
+# instances are seen once this interval has passed.
+VERSION_CHECK_INTERVAL = 5
+
+# Cookie set for VERSION_CHECK_INTERVAL seconds after a user's own write, so
+# that their next pages check every cached version, whichever instance
+# serves them
+RECENT_WRITE_COOKIE = "recent_write"
+
+# Memcache key prefix for entity version counters
+VERSION_PREFIX = "ver:"
+
+
+class LRUCache(object):
+    """Thread-safe, in-process LRU cache bounded by entry count, total bytes
+        and entry age.  Each entry carries a version so that a value which
+        has been changed by another instance can be rejected on read, and
+        remembers when that version was last confirmed."""
+
+    def __init__(self, max_entries, max_bytes, ttl, check_interval):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    """Return the cached value for key if its version was confirmed within
+        the check interval, or None if the caller must confirm it with get.
+        Only hits are counted, as the caller follows every None with get."""
+    def get_recent(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is None or entry[3] < now or
+                    entry[4] + self.check_interval < now):
+                return None
+
+            # Move entry to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    """Return the cached value for key, or None if it is missing, expired
+        or not at the requested version"""
+    def get(self, key, version=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, entry_version, size, expires, checked = entry
+            if expires < now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if version is not None and entry_version != version:
+                self._remove(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+
+            # Move entry to the most recently used end, recording when its
+            # version was last confirmed
+            del self._entries[key]
+            self._entries[key] = (value, entry_version, size, expires,
+                                  now if version is not None else checked)
+            self.hits += 1
+            return value
+
+    """Store value under key, evicting least recently used entries until
+        the cache is back within its bounds"""
+    def set(self, key, value, version=None, size=0):
+        # Never store a value that could not fit on its own
+        if size > self.max_bytes:
+            return
+
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, version, size, now + self.ttl, now)
+            self._bytes += size
+
+            while (len(self._entries) > self.max_entries or
+                   self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    """Drop key from the cache if present"""
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    """Drop every entry from the cache"""
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    """Return hit-rate, eviction and size statistics"""
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            hit_rate = float(self.hits) / lookups if lookups else 0.0
+            return dict(entries=len(self._entries),
+                        bytes=self._bytes,
+                        hits=self.hits,
+                        misses=self.misses,
+                        hit_rate=hit_rate,
+                        evictions=self.evictions,
+                        expirations=self.expirations,
+                        invalidations=self.invalidations)
+
+    # Caller must hold self._lock
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[2]
+
+
+# Shared by all request threads on this instance
+entity_cache = LRUCache(ENTITY_CACHE_ENTRIES, ENTITY_CACHE_BYTES,
+                        ENTITY_CACHE_TTL, VERSION_CHECK_INTERVAL)
+
+
+"""Approximate memory cost of an entity by its serialized size"""
+def entity_size(entity):
+    return len(db.model_to_protobuf(entity).Encode())
+
+
+"""Fetch the version counters of the given keys from memcache in a single
+    round-trip.  Keys without a counter are treated as version 0."""
+def get_versions(keys):
+    names = [str(key) for key in keys]
+    found = memcache.get_multi(names, key_prefix=VERSION_PREFIX)
+    return dict((name, found.get(name, 0)) for name in names)
+
+
+"""Bump the version of each key so that every instance drops its cached
+    copy.  Must be called after the write has been committed."""
+def invalidate(*keys):
+    names = [str(key) for key in keys]
+    if not names:
+        return
+    memcache.offset_multi(dict((name, 1) for name in names),
+                          key_prefix=VERSION_PREFIX, initial_value=0)
+    for name in names:
+        entity_cache.delete(name)
+
+
+"""Cache-aware replacement for db.get.  Accepts a key, encoded key string or
+    list of either and returns entities in the same shape.  Entities whose
+    version was confirmed recently are served without any RPC, unless confirm
+    is set; the rest are checked against memcache in one round-trip, and only
+    keys missing or stale in the cache are read from the datastore, in one
+    batch.  Returned entities are shared between requests and must not be
+    modified."""
+def cached_get(keys, confirm=False):
+    multiple = isinstance(keys, (list, tuple))
+    if not multiple:
+        keys = [keys]
+    keys = [db.Key(k) if isinstance(k, basestring) else k for k in keys]
+    if not keys:
+        return []
+
+    # Serve recently confirmed entities straight from the instance cache
+    found = {}
+    unchecked = []
+    for key in keys:
+        entity = None if confirm else entity_cache.get_recent(str(key))
+        if entity is None:
+            unchecked.append(key)
+        else:
+            found[str(key)] = entity
+
+    # Serve the rest at their current version from the instance cache
+    versions = get_versions(unchecked) if unchecked else {}
+    missing = []
+    for key in unchecked:
+        name = str(key)
+        entity = entity_cache.get(name, versions[name])
+        if entity is None:
+            missing.append(key)
+        else:
+            found[name] = entity
+
+    # Load the rest from the datastore in a single call
+    if missing:
+        for key, entity in zip(missing, db.get(missing)):
+            if entity is not None:
+                name = str(key)
+                entity_cache.set(name, entity, versions[name],
+                                 entity_size(entity))
+                found[name] = entity
+
+    entities = [found.get(str(key)) for key in keys]
+    return entities if multiple else entities[0]
+
+
+"""Retrieve the 10 most recent blog post and a dict of their comments by
+    encoded key, all loaded through the instance cache"""
+def front_page(confirm=False):
+    # Retrieve keys of the 10 most recent blog post from datastore and
+    # load the post themselves through the instance cache
+    post_keys = db.GqlQuery("SELECT __key__ FROM Post ORDER BY created "
+                            "DESC LIMIT 10")
+    return load_feed(list(post_keys), confirm)
+
+
+"""Load the blog post for a list of keys, skipping any that were deleted,
+    and a dict of their comments by encoded key, all in batched lookups
+    through the instance cache"""
+def load_feed(post_keys, confirm=False):
+    entries = [post for post in cached_get(post_keys, confirm) if post]
+    return entries, load_comments(entries, confirm)
+
+
+"""Load every comment on the given blog post in one batched lookup and
+    return them in a dict by encoded key"""
+def load_comments(entries, confirm=False):
+    comment_keys = [c for entry in entries for c in entry.comments]
+    comments = cached_get(comment_keys, confirm)
+    return dict((str(c.key()), c) for c in comments if c)
+
+
+# - - - Trending Feed - - - - - - - - - - - - - - - - - - -
+
+# Only blog post created within this window are ranked
+TRENDING_WINDOW = datetime.timedelta(days=7)
+TRENDING_SIZE = 10
+TRENDING_BATCH_SIZE = 100
+
+# A comment counts for this many likes, and scores decay with age in hours
+# raised to the gravity
+TRENDING_COMMENT_WEIGHT = 2
+TRENDING_GRAVITY = 1.5
+
+TRENDING_CACHE_KEY = "feed:trending"
+
+
+"""Time-decayed popularity of a blog post"""
+def trending_score(post, now):
+    age = (now - post.created).total_seconds() / 3600
+    points = post.likes + TRENDING_COMMENT_WEIGHT * len(post.comments) + 1
+    return points / (age + 2) ** TRENDING_GRAVITY
+
+
+"""Rank recent blog post in batches and store the top keys as the trending
+    feed, both in the datastore and memcache"""
+def compute_trending():
+    now = datetime.datetime.now()
+    query = Post.all().filter("created >=", now - TRENDING_WINDOW)
+
+    # Keep only the best TRENDING_SIZE post in memory while paging through
+    top = []
+    batch = query.fetch(TRENDING_BATCH_SIZE)
+    while batch:
+        for post in batch:
+            item = (trending_score(post, now), str(post.key()))
+            if len(top) < TRENDING_SIZE:
+                heapq.heappush(top, item)
+            else:
+                heapq.heappushpop(top, item)
+        if len(batch) < TRENDING_BATCH_SIZE:
+            break
+        query.with_cursor(query.cursor())
+        batch = query.fetch(TRENDING_BATCH_SIZE)
+
+    names = [name for score, name in sorted(top, reverse=True)]
+    Feed(key_name="trending", posts=[db.Key(n) for n in names]).put()
+    memcache.set(TRENDING_CACHE_KEY, names)
+    return names
+
+
+"""Return the encoded keys of the trending feed, reading the datastore
+    copy only when memcache has lost it"""
+def trending_keys():
+    names = memcache.get(TRENDING_CACHE_KEY)
+    if names is None:
+        feed = Feed.get_by_key_name("trending")
+        names = [str(key) for key in feed.posts] if feed else []
+        memcache.add(TRENDING_CACHE_KEY, names)
+    return names
+
+
+# - - - Timelines - - - - - - - - - - - - - - - - - - -
+
+TIMELINE_SIZE = 20
+
+# Authors reaching this many followers become popular and are no longer
+# fanned out on write.  Their followers keep them in popular_following and
+# read their recent post when loading a timeline instead.  Popular authors
+# stay popular, so none of their post can be missing from a timeline.
+FANOUT_MAX_FOLLOWERS = 5000
+FANOUT_BATCH_SIZE = 500
+PROMOTE_BATCH_SIZE = 100
+
+# Key ranges of TIMELINE_SIZE entries read while looking for post that were
+# not deleted
+TIMELINE_MAX_FETCHES = 5
+
+# Timeline entries older than this are removed by a daily job
+TIMELINE_RETENTION = datetime.timedelta(days=90)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+"""Timeline entry key name for a blog post.  The creation time is inverted
+    so that ascending key order is newest first."""
+def timeline_name(post_key, created):
+    micros = int((created - EPOCH).total_seconds() * 1000000)
+    return "%019d-%d-%d" % (10 ** 18 - micros, post_key.parent().id(),
+                            post_key.id())
+
+
+"""Blog post key referenced by a timeline entry key"""
+def timeline_post_key(entry_key):
+    author_id, post_id = entry_key.name().split("-")[1:]
+    return db.Key.from_path("User", int(author_id), "Post", int(post_id))
+
+
+"""Timeline entries placing a blog post on each of the given user's
+    timelines"""
+def timeline_entries(post, user_keys):
+    post_key = post.key()
+    name = timeline_name(post_key, post.created)
+    return [TimelineEntry(key_name=name, parent=user_key,
+                          author=post_key.parent().id())
+            for user_key in user_keys]
+
+
+"""Load the home timeline of a user: the fanned out entries under the user,
+    merged with recent post of the few followed authors too popular to fan
+    out to"""
+def load_timeline(user_key, confirm=False):
+    # Fanned out post, newest first, in key range queries continued until
+    # enough of the post still exist.  Entries of deleted post are removed
+    # on the way, so later reads do not skip them again.
+    query = TimelineEntry.all(keys_only=True).ancestor(user_key)
+    query.order("__key__")
+    entries = []
+    deleted = []
+    for i in xrange(TIMELINE_MAX_FETCHES):
+        entry_keys = query.fetch(TIMELINE_SIZE)
+        post_keys = [timeline_post_key(k) for k in entry_keys]
+        for key, post in zip(entry_keys, cached_get(post_keys, confirm)):
+            if post:
+                entries.append(post)
+            else:
+                deleted.append(key)
+        if len(entries) >= TIMELINE_SIZE or len(entry_keys) < TIMELINE_SIZE:
+            break
+        query.with_cursor(query.cursor())
+    if deleted:
+        db.delete(deleted)
+
+    # Fan out on read for popular authors
+    user = cached_get(user_key, confirm)
+    post_keys = []
+    for author_key in user.popular_following if user else []:
+        query = Post.all(keys_only=True).ancestor(author_key)
+        post_keys += query.order("-created").fetch(TIMELINE_SIZE)
+
+    # Post from before an author became popular come from both sources
+    seen = set(str(post.key()) for post in entries)
+    unique = []
+    for key in post_keys:
+        if str(key) not in seen:
+            seen.add(str(key))
+            unique.append(key)
+
+    entries += [post for post in cached_get(unique, confirm) if post]
+    entries.sort(key=lambda post: post.created, reverse=True)
+    entries = entries[:TIMELINE_SIZE]
+    return entries, load_comments(entries, confirm)
+
+
+# - - - Unit of Work - - - - - - - - - - - - - - - - - - -
+
+# Largest number of entities the datastore accepts in one batch call
+MAX_BATCH_SIZE = 500
+
+
+"""Return the root key of the entity group an entity or key belongs to, or
+    None if it cannot be known before the entity is first written"""
+def entity_group(entity):
+    if isinstance(entity, db.Key):
+        key = entity
+    elif entity.has_key():
+        key = entity.key()
+    else:
+        key = entity.parent_key()
+        if key is None:
+            return None
+
+    while key.parent():
+        key = key.parent()
+    return key
+
+
+"""Read the entities for a list of queued updates, apply each update and
+    return the entities to write and the keys to delete.  Updates missing
+    any of their required entities are skipped, optional ones are passed as
+    None.  Entities queued for deletion are never written back."""
+def apply_updates(updates, deletes):
+    keys = []
+    for update_keys, modify, optional in updates:
+        keys += [key for key in update_keys if key not in keys]
+    fresh = dict((str(key), entity) for key, entity in zip(keys, db.get(keys)))
+
+    changed = []
+    removed = []
+    for update_keys, modify, optional in updates:
+        entities = [fresh[str(key)] for key in update_keys]
+        if any(entity is None and key not in optional
+               for key, entity in zip(update_keys, entities)):
+            continue
+
+        # Entities and keys returned by modify are created and deleted, and
+        # seen as such by later updates
+        for item in modify(*entities) or []:
+            if isinstance(item, db.Key):
+                removed.append(item)
+                fresh[str(item)] = None
+            else:
+                entities.append(item)
+                fresh[str(item.key())] = item
+
+        changed += [e for e in entities if e is not None and
+                    not any(e is c for c in changed)]
+    changed = [e for e in changed
+               if e.key() not in deletes and e.key() not in removed]
+    return changed, removed
+
+
+class UnitOfWork(object):
+    """Per-request identity map and write queue.  Each entity is read from
+        the datastore at most once per request, and queued writes are sent in
+        one batch on flush, inside a transaction when they all belong to the
+        same entity group.
+
+        Entities passed to put are written as they are, so a value read
+        earlier in the request can overwrite a concurrent change.  Changes
+        that depend on the stored value, such as counters, or on whether an
+        entity exists, such as toggling a like, must be queued with update or
+        increment, which re-read the entities inside the write transaction."""
+
+    def __init__(self):
+        self._identity = {}
+        self._puts = []
+        self._deletes = []
+        self._updates = []
+        self.wrote = False
+
+    """Accepts a key, encoded key string or list of either and returns the
+        entities in the same shape, fetching unseen keys in one db.get.
+        Unlike cached_get, the returned entities are private to this request
+        and safe to modify."""
+    def get(self, keys):
+        multiple = isinstance(keys, (list, tuple))
+        if not multiple:
+            keys = [keys]
+        keys = [db.Key(k) if isinstance(k, basestring) else k for k in keys]
+
+        # Fetch each key not already in the identity map exactly once
+        missing = []
+        for key in keys:
+            if str(key) not in self._identity and key not in missing:
+                missing.append(key)
+        if missing:
+            for key, entity in zip(missing, db.get(missing)):
+                self._identity[str(key)] = entity
+
+        entities = [self._identity[str(key)] for key in keys]
+        return entities if multiple else entities[0]
+
+    """Queue entity to be written on flush"""
+    def put(self, entity):
+        if not any(queued is entity for queued in self._puts):
+            self._puts.append(entity)
+
+    """Queue an entity or key to be deleted on flush"""
+    def delete(self, entity):
+        key = entity if isinstance(entity, db.Key) else entity.key()
+        self._puts = [queued for queued in self._puts
+                      if not (queued.has_key() and queued.key() == key)]
+        if key not in self._deletes:
+            self._deletes.append(key)
+        self._identity[str(key)] = None
+
+    """Queue a read-modify-write of the entities at keys, which must share
+        an entity group.  On flush the entities are read again inside the
+        write transaction and passed to modify, which changes them in place.
+        The update is skipped if any entity is missing, except those at the
+        optional keys, which are passed as None.  modify may return a list of
+        new entities, with complete keys in the same group, to create and of
+        keys to delete in the same transaction.  The transaction may be
+        retried, so modify must only change the entities it is given."""
+    def update(self, keys, modify, optional=()):
+        if not isinstance(keys, (list, tuple)):
+            keys = [keys]
+        keys = [db.Key(k) if isinstance(k, basestring) else k for k in keys]
+        optional = [db.Key(k) if isinstance(k, basestring) else k
+                    for k in optional]
+        self._updates.append((keys, modify, optional))
+
+    """Queue adding delta to an integer property of the entity at key"""
+    def increment(self, key, name, delta):
+        def modify(entity):
+            setattr(entity, name, getattr(entity, name) + delta)
+        self.update(key, modify)
+
+    """Write every queued entity, then invalidate cached copies of them"""
+    def flush(self):
+        puts, deletes, updates = self._puts, self._deletes, self._updates
+        if not puts and not deletes and not updates:
+            return
+        self._puts, self._deletes, self._updates = [], [], []
+        self.wrote = True
+
+        update_keys = [key for keys, modify, optional in updates
+                       for key in keys]
+        groups = set(entity_group(e) for e in puts + deletes + update_keys)
+        if ((updates or len(puts) + len(deletes) > 1) and
+                len(groups) == 1 and None not in groups and
+                len(puts) + len(update_keys) <= MAX_BATCH_SIZE and
+                len(deletes) <= MAX_BATCH_SIZE):
+            # Single entity group, so the whole batch can commit atomically
+            def write():
+                entities, removed = apply_updates(updates, deletes)
+                entities = puts + entities
+                if entities:
+                    db.put(entities)
+                if deletes or removed:
+                    db.delete(deletes + removed)
+                return entities, removed
+            written, removed = db.run_in_transaction(write)
+        else:
+            for i in xrange(0, len(puts), MAX_BATCH_SIZE):
+                db.put(puts[i:i + MAX_BATCH_SIZE])
+
+            # Each update still reads and writes in its own transaction,
+            # before the deletes so it sees entities queued for deletion
+            written = list(puts)
+            removed = []
+            for update in updates:
+                def write(update=update):
+                    entities, removed = apply_updates([update], deletes)
+                    if entities:
+                        db.put(entities)
+                    if removed:
+                        db.delete(removed)
+                    return entities, removed
+                entities, keys = db.run_in_transaction(write)
+                written += entities
+                removed += keys
+
+            for i in xrange(0, len(deletes), MAX_BATCH_SIZE):
+                db.delete(deletes[i:i + MAX_BATCH_SIZE])
+
+        for entity in written:
+            self._identity[str(entity.key())] = entity
+        for key in removed:
+            self._identity[str(key)] = None
+        invalidate(*[entity.key() for entity in written] + deletes + removed)
+
+
+# - - - Rate Limiting - - - - - - - - - - - - - - - - - - -
+
+# Write limits as (requests, seconds), per user and per blog post
+LIKE_RATE_LIMITS = dict(user=(30, 60), post=(120, 60))
+COMMENT_RATE_LIMITS = dict(user=(10, 60), post=(60, 60))
+
+# Attempts at a compare-and-set before giving up on a contended bucket
+RATE_LIMIT_CAS_RETRIES = 5
+
+
+"""Take a token from the named bucket and return 0, or if the bucket is
+    empty the number of seconds until it holds a token again.  A bucket
+    holds up to `limit` tokens and refills continuously at `limit` tokens
+    per `period` seconds, so bursts never exceed `limit`.  It is stored in
+    memcache as (tokens, last refill time) and updated with compare-and-set;
+    a bucket left alone for `period` seconds is full, so it may expire."""
+def take_token(name, limit, period):
+    client = memcache.Client()
+    key = "rate:%s" % name
+    rate = float(limit) / period
+
+    for attempt in xrange(RATE_LIMIT_CAS_RETRIES):
+        now = time.time()
+        bucket = client.gets(key)
+        if bucket is None:
+            # New bucket starts full, less the token taken now
+            if client.add(key, (limit - 1, now), time=period):
+                return 0
+            continue
+
+        tokens, refilled = bucket
+        tokens = min(limit, tokens + (now - refilled) * rate)
+        if tokens < 1:
+            return int(math.ceil((1 - tokens) / rate))
+        if client.cas(key, (tokens - 1, now), time=period):
+            return 0
+
+    # Let requests through if memcache is unavailable or the bucket is too
+    # contended to update
+    return 0
+
+
+"""Decorator for write handlers taking an encoded post key.  Throttles
+    signed in users per user and per post, responding with 429 once either
+    bucket is empty."""
+def rate_limited(action, limits):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, web_safe_post_key, *args, **kw):
+            user_key = self.check_cookie() and self.get_user_key()
+            if user_key:
+                buckets = [("%s:user:%s" % (action, user_key.id()),
+                            limits["user"]),
+                           ("%s:post:%s" % (action, web_safe_post_key),
+                            limits["post"])]
+                for name, (limit, period) in buckets:
+                    retry_after = take_token(name, limit, period)
+                    if retry_after:
+                        self.response.set_status(429, "Too Many Requests")
+                        retry = str(retry_after)
+                        self.response.headers["Retry-After"] = retry
+                        self.write("Too many requests, please slow down.")
+                        return
+            return method(self, web_safe_post_key, *args, **kw)
+        return wrapper
+    return decorator
+
+
 # - - - Base Handler - - - - - - - - - - - - - - - - - - -
 
 class Handler(webapp2.RequestHandler):
     """Class implemented to help make writing and rendering templates easier"""
 
+    """Gives each request its own unit of work and writes anything the
+        handler queued but did not flush once it returns successfully.
+        Requests shortly after the user's own write confirm every cached
+        version, as the write may have been made on another instance."""
+    def dispatch(self):
+        self.uow = UnitOfWork()
+        cookie = self.request.cookies.get(RECENT_WRITE_COOKIE)
+        self.confirm_versions = bool(cookie)
+        response = super(Handler, self).dispatch()
+        self.uow.flush()
+        if self.uow.wrote:
+            self.response.headers.add_header(
+                "Set-Cookie", "%s=1; Max-Age=%d; Path=/" %
+                (RECENT_WRITE_COOKIE, VERSION_CHECK_INTERVAL))
+        return response
+
     """Simplified self.response.write method, reduces typing"""
     def write(self, *a, **kw):
         self.response.write(*a, **kw)
@@ -165,12 +887,11 @@ class Handler(webapp2.RequestHandler):
     """Retrieve the 10 most recent entries and render home page with error if
         necessary"""
     def render_home(self, error=""):
-        # Retrieve 10 most recent blog post from datastore
-        entries = db.GqlQuery("SELECT * FROM Post ORDER BY created DESC LIMIT "
-                              "10")
+        entries, comments = front_page(self.confirm_versions)
 
         # Render home page with error message
-        self.render("home.html", entries=entries, error=error, db=db)
+        self.render("home.html", entries=entries, comments=comments,
+                    error=error)
 
 
 # - - - Main Page Handler - - - - - - - - - - - - - - - - - - -
@@ -348,8 +1069,15 @@ class NewPostPage(Handler):
                 # as parent relationship
                 post = Post(subject=subject, entry=content, parent=prof_key)
 
-                # Commit post to datastore
-                post.put()
+                # Commit post and author post count to datastore in one
+                # transaction
+                self.uow.increment(prof_key, "post_count", 1)
+                self.uow.put(post)
+                self.uow.flush()
+
+                # Fan post out to followers' timelines in the background
+                taskqueue.add(url="/tasks/fanout",
+                              params=dict(post=str(post.key())))
 
                 # Redirect to blog post permalink
                 self.redirect('/blog/%s' % str(post.key().id()))
@@ -375,7 +1103,7 @@ class PostPage(Handler):
 
             # Use user key to generate blog post key and retrieve blog post
             key = db.Key.from_path("Post", int(post_id), parent=prof_key)
-            post = db.get(key)
+            post = cached_get(key, self.confirm_versions)
 
             # If post is not in datastore, return 404
             if not post:
@@ -408,8 +1136,8 @@ class EditPage(Handler):
 
                 self.render_home(error)
             else:
-                # Get blog post from datastore
-                post = db.get(post_key)
+                # Get blog post from instance cache or datastore
+                post = cached_get(post_key, self.confirm_versions)
 
                 # If post is not in datastore, return 404
                 if not post:
@@ -444,19 +1172,21 @@ class EditPage(Handler):
                 # Verify both subject and content are filled out
                 if subject and content:
                     # Get post entity from key
-                    post = db.get(post_key)
+                    post = self.uow.get(post_key)
 
                     # If post is not in datastore, return 404
                     if not post:
                         self.error(404)
                         return
 
-                    # Set blog post subject and content to user input
-                    post.subject = subject
-                    post.entry = content
+                    # Set blog post subject and content to user input on a
+                    # fresh copy, so concurrent likes and comments are kept
+                    def edit(post):
+                        post.subject = subject
+                        post.entry = content
 
-                    # Commit update to datastore
-                    post.put()
+                    # Queue update, written when the handler returns
+                    self.uow.update(post_key, edit)
 
                     # Redirect to blog post permalink
                     self.redirect('/blog/%s' % str(post.key().id()))
@@ -491,8 +1221,8 @@ class DeletePage(Handler):
 
                 self.render_home(error)
             else:
-                # Get blog post entity from datastore
-                post = db.get(post_key)
+                # Get blog post entity from instance cache or datastore
+                post = cached_get(post_key, self.confirm_versions)
 
                 # If post is not in datastore, return 404
                 if not post:
@@ -521,7 +1251,7 @@ class DeletePage(Handler):
                 self.render_home(error)
             else:
                 # Get post entity from key
-                post = db.get(post_key)
+                post = self.uow.get(post_key)
 
                 # If post is not in datastore, return 404
                 if not post:
@@ -529,14 +1259,21 @@ class DeletePage(Handler):
                     return
 
                 # Delete related comments from datastore
-                comments = post.comments
-                for comment in comments:
-                    c_key = db.Key(comment)
-                    c_entity = db.get(c_key)
-                    c_entity.delete()
-
-                # Delete post from datastore
-                post.delete()
+                for c_key in post.comments:
+                    self.uow.delete(db.Key(c_key))
+
+                # Remove the post, its likes and comments from author stats,
+                # as they stand when the post is deleted
+                def remove_post(author, post):
+                    author.post_count -= 1
+                    author.likes_received -= post.likes
+                    author.comments_received -= len(post.comments)
+                self.uow.update([user_key, post_key], remove_post)
+
+                # Delete post and its comments from datastore in one
+                # transaction
+                self.uow.delete(post)
+                self.uow.flush()
 
                 # Delay before redirect to that home page, so
                 # delete action can remove entity from datastore
@@ -552,41 +1289,50 @@ class LikeHandler(Handler):
     """Like handler increments the number of like
     for a post when clicked by a user"""
 
+    @rate_limited("like", LIKE_RATE_LIMITS)
     def post(self, web_safe_post_key):
         # Verify cookie
         if not self.check_cookie():
             self.redirect("/login")
         else:
-            # Get user profile key and entity from key
+            # Get user profile and post entity in a single lookup
             user_key = self.get_user_key()
-            creator = db.get(user_key)
-
-            # Get encoded key from url and post entity from key
             post_key = db.Key(web_safe_post_key)
-            post = db.get(post_key)
+            creator, post = self.uow.get([user_key, post_key])
 
             # If post is not in datastore, return 404
             if not post:
                 self.error(404)
                 return
 
-            # See if user has already like this post
-            user_already_liked = db.GqlQuery("SELECT * FROM Like WHERE creator =:1 "
-                               "AND ANCESTOR IS :2 ", creator.username,
-                               post_key).get()
-
             if post_key.parent() == user_key:
                 # If user is author of post, re-render page with error
                 error = "Sorry, you cannot like your own post."
 
                 self.render_home(error)
-            elif user_already_liked:
-                # Delete like from Like table
-                user_already_liked.delete()
-
-                # Decrease post likes by 1
-                post.likes -= 1
-                post.put()
+            else:
+                # Likes are stored under the post with the user id as key
+                # name.  Older likes have numeric ids, so an existing like
+                # by the user is looked up first.
+                query = Like.all(keys_only=True).ancestor(post_key)
+                like_key = (query.filter("creator =", creator.username).get()
+                            or db.Key.from_path("Like", str(user_key.id()),
+                                                parent=post_key))
+
+                # Like the post if not liked yet, otherwise unlike it, and
+                # update post and author likes, deciding inside the
+                # transaction so repeated clicks cannot count twice
+                def toggle_like(like, post, author):
+                    delta = -1 if like else 1
+                    post.likes += delta
+                    author.likes_received += delta
+                    if like:
+                        return [like.key()]
+                    return [Like(key=like_key, creator=creator.username)]
+
+                self.uow.update([like_key, post_key, post_key.parent()],
+                                toggle_like, optional=[like_key])
+                self.uow.flush()
 
                 # Delay before redirecting so datastore
                 # can update before page render
@@ -594,20 +1340,6 @@ class LikeHandler(Handler):
 
                 # Redirect to home page
                 self.redirect("/")
-            else:
-                # Create like entity for new like, setting blog post as parent
-                like = Like(creator=creator.username, parent=post_key)
-
-                # Add like to Like table
-                like.put()
-
-                # Increase like count by 1
-                post.likes += 1
-                post.put()
-                time.sleep(0.5)
-
-                # Redirect to home page
-                self.redirect("/")
 
 
 # - - - Comment Page Handler - - - - - - - - - - - - - - - - - - -
@@ -623,18 +1355,16 @@ class CommentPage(Handler):
             # Render comment page
             self.render("comment.html")
 
+    @rate_limited("comment", COMMENT_RATE_LIMITS)
     def post(self, web_safe_post_key):
         # Verify cookie
         if not self.check_cookie():
             self.redirect("/login")
         else:
-            # Get user profile
+            # Get user profile and post entity in a single lookup
             user_key = self.get_user_key()
-            creator = db.get(user_key)
-
-            # Get encoded key from url and post entity from key
             post_key = db.Key(web_safe_post_key)
-            post = db.get(post_key)
+            creator, post = self.uow.get([user_key, post_key])
 
             # If post is not in datastore, return 404
             if not post:
@@ -645,19 +1375,23 @@ class CommentPage(Handler):
             content = self.request.get("content")
 
             if content:
-                # Create comment entity with post as parent
-                comment = Comment(creator=creator.username,
-                                  entry=content, parent=post_key)
-
-                # Add comment to datastore comment kind
-                comment.put()
-
-                # Get comment key
-                com_key = comment.key()
-
-                # Add comment key to blog post entity
-                post.comments.append(str(com_key))
-                post.put()
+                # Reserve an id for the comment with post as parent, so its
+                # key is known before anything is written
+                com_id = db.allocate_ids(
+                    db.Key.from_path("Comment", 1, parent=post_key), 1)[0]
+                com_key = db.Key.from_path("Comment", com_id, parent=post_key)
+
+                # Create comment entity, add its key to blog post entity and
+                # count it for the author, unless the post has been deleted
+                def add_comment(author, post):
+                    post.comments.append(str(com_key))
+                    author.comments_received += 1
+                    return [Comment(key=com_key, creator=creator.username,
+                                    entry=content)]
+
+                # Write comment, post and author together in one transaction
+                self.uow.update([post_key.parent(), post_key], add_comment)
+                self.uow.flush()
 
                 # Redirect to home page after delay,
                 # allowing time for datastore update
@@ -680,13 +1414,12 @@ class EditComment(Handler):
         if not self.check_cookie():
             self.redirect("/login")
         else:
-            # Get user profile key and profile
+            # Get user profile and comment entity from instance cache or
+            # datastore in a single lookup
             user_key = self.get_user_key()
-            user = db.get(user_key)
-
-            # Get encoded key from url and post entity
             c_key = db.Key(web_safe_comment_key)
-            comment = db.get(c_key)
+            user, comment = cached_get([user_key, c_key],
+                                       self.confirm_versions)
 
             # If comment is not in datastore, return 404
             if not comment:
@@ -707,13 +1440,10 @@ class EditComment(Handler):
         if not self.check_cookie():
             self.redirect("/login")
         else:
-            # Get user profile key and profile
+            # Get user profile and comment entity in a single lookup
             user_key = self.get_user_key()
-            user = db.get(user_key)
-
-            # Get encoded key from url and post entity
             c_key = db.Key(web_safe_comment_key)
-            comment = db.get(c_key)
+            user, comment = self.uow.get([user_key, c_key])
 
             # If comment is not in datastore, return 404
             if not comment:
@@ -730,19 +1460,12 @@ class EditComment(Handler):
                 content = self.request.get("content")
 
                 if content:
-                    # Get post entity from key
-                    comment = db.get(c_key)
-
-                    # If post is not in datastore, return 404
-                    if not comment:
-                        self.error(404)
-                        return
-
                     # Set comment content to user input
                     comment.entry = content
 
                     # Commit update to datastore
-                    comment.put()
+                    self.uow.put(comment)
+                    self.uow.flush()
 
                     # Redirect to home page with delay so
                     # datastore can update before page render
@@ -764,13 +1487,12 @@ class DeleteComment(Handler):
         if not self.check_cookie():
             self.redirect("/login")
         else:
-            # Get user profile key and profile
+            # Get user profile and comment entity from instance cache or
+            # datastore in a single lookup
             user_key = self.get_user_key()
-            user = db.get(user_key)
-
-            # Get encoded key from url and comment entity
             c_key = db.Key(web_safe_comment_key)
-            comment = db.get(c_key)
+            user, comment = cached_get([user_key, c_key],
+                                       self.confirm_versions)
 
             # If post is not in datastore, return 404
             if not comment:
@@ -791,13 +1513,12 @@ class DeleteComment(Handler):
         if not self.check_cookie():
             self.redirect("/login")
         else:
-            # Get user profile key and profile
+            # Get user profile, comment and parent post entities in a
+            # single lookup
             user_key = self.get_user_key()
-            user = db.get(user_key)
-
-            # Get encoded key from url and comment entity
             c_key = db.Key(web_safe_comment_key)
-            comment = db.get(c_key)
+            p_key = c_key.parent()
+            user, comment, post = self.uow.get([user_key, c_key, p_key])
 
             # If post is not in datastore, return 404
             if not comment:
@@ -810,20 +1531,22 @@ class DeleteComment(Handler):
 
                 self.render_home(error)
             else:
-                # Get comment parent
-                p_key = c_key.parent()
-                post = db.get(p_key)
                 # If post is not in datastore, return 404
-                if not comment:
+                if not post:
                     self.error(404)
                     return
 
-                # # Remove comment from blog post comments list
-                post.comments.remove(web_safe_comment_key)
-                post.put()
+                # Remove comment from blog post comments list and author
+                # stats, unless an earlier request already removed it
+                def remove_comment(author, post):
+                    if web_safe_comment_key in post.comments:
+                        post.comments.remove(web_safe_comment_key)
+                        author.comments_received -= 1
+                self.uow.update([p_key.parent(), p_key], remove_comment)
 
-                # Delete post from datastore
-                comment.delete()
+                # Delete comment and update post in one transaction
+                self.uow.delete(comment)
+                self.uow.flush()
 
                 # Delay before redirect so that home delete
                 # action can remove entity from datastore
@@ -833,6 +1556,540 @@ class DeleteComment(Handler):
                 self.redirect("/")
 
 
+# - - - Author Profile Page Handler - - - - - - - - - - - - - - - - - - -
+
+PROFILE_PAGE_SIZE = 10
+
+
+class ProfilePage(Handler):
+    """Author profile page listing an author's blog post, newest first, with
+        their post, like and comment counts"""
+
+    def get(self, username):
+        # Verify cookie
+        if not self.check_cookie():
+            self.redirect("/login")
+        else:
+            # Get author from username, with stats from the instance cache
+            author_key = db.GqlQuery("SELECT __key__ FROM User WHERE "
+                                     "username =:1", username).get()
+            author = author_key and cached_get(author_key,
+                                               self.confirm_versions)
+
+            # If author is not in datastore, return 404
+            if not author:
+                self.error(404)
+                return
+
+            # Author's post are in their entity group, so an ancestor query
+            # sees every post as soon as it is written
+            query = Post.all().ancestor(author_key).order("-created")
+            cursor = self.request.get("cursor")
+            if cursor:
+                try:
+                    query.with_cursor(cursor)
+                except db.BadValueError:
+                    self.error(400)
+                    return
+            entries = query.fetch(PROFILE_PAGE_SIZE)
+
+            # Only offer another page if this one was full
+            next_cursor = None
+            if len(entries) == PROFILE_PAGE_SIZE:
+                next_cursor = query.cursor()
+
+            # Render profile page with a page of the author's post
+            self.render("profile.html", author=author, entries=entries,
+                        comments=load_comments(entries, self.confirm_versions),
+                        next_cursor=next_cursor)
+
+
+# Users recounted by one task
+RECOUNT_BATCH_SIZE = 50
+
+
+class RecountStatsTask(Handler):
+    """Recounts every author's stats and followers from their entity group.
+        Run once by an administrator after upgrading from a version without
+        author stats, as those users start from zero; safe to run again."""
+
+    def get(self):
+        taskqueue.add(url="/tasks/recount_stats")
+        self.write("Recount started")
+
+    def post(self):
+        query = User.all(keys_only=True)
+        cursor = self.request.get("cursor")
+        if cursor:
+            query.with_cursor(cursor)
+        user_keys = query.fetch(RECOUNT_BATCH_SIZE)
+
+        # Count inside each author's transaction, so concurrent writes are
+        # neither lost nor counted twice
+        def recount(user):
+            user_key = user.key()
+            user.post_count = 0
+            user.likes_received = 0
+            user.comments_received = 0
+            for post in Post.all().ancestor(user_key):
+                user.post_count += 1
+                user.likes_received += post.likes
+                user.comments_received += len(post.comments)
+            follows = Follow.all(keys_only=True).ancestor(user_key)
+            user.followers = follows.count(limit=None)
+
+        for user_key in user_keys:
+            uow = UnitOfWork()
+            uow.update(user_key, recount)
+            uow.flush()
+
+        # Continue with the next batch of users in a new task
+        if len(user_keys) == RECOUNT_BATCH_SIZE:
+            taskqueue.add(url="/tasks/recount_stats",
+                          params=dict(cursor=query.cursor()))
+
+
+# - - - Trending Page Handlers - - - - - - - - - - - - - - - - - - -
+
+class TrendingPage(Handler):
+    """Home page variant listing the blog post ranked by the trending job"""
+
+    def get(self):
+        # Verify cookie
+        if not self.check_cookie():
+            self.redirect("/login")
+        else:
+            # Load precomputed feed with one cached read and a batched get
+            entries, comments = load_feed(trending_keys(),
+                                          self.confirm_versions)
+
+            # Render home page with trending post
+            self.render("home.html", entries=entries, comments=comments)
+
+
+class TrendingJob(Handler):
+    """Cron job recomputing the trending feed, see cron.yaml"""
+
+    def get(self):
+        names = compute_trending()
+        self.write("Ranked %d post" % len(names))
+
+
+# - - - Timeline Page Handlers - - - - - - - - - - - - - - - - - - -
+
+class TimelinePage(Handler):
+    """Personalized home page listing blog post by the user and the authors
+        they follow"""
+
+    def get(self):
+        # Verify cookie
+        if not self.check_cookie():
+            self.redirect("/login")
+        else:
+            entries, comments = load_timeline(self.get_user_key(),
+                                              self.confirm_versions)
+
+            # Render home page with timeline post
+            self.render("home.html", entries=entries, comments=comments)
+
+
+class FollowHandler(Handler):
+    """Follow handler follows the author of a blog post, or unfollows them
+        if already followed"""
+
+    def post(self, user_id):
+        # Verify cookie
+        if not self.check_cookie():
+            self.redirect("/login")
+        else:
+            user_key = self.get_user_key()
+            author_key = db.Key.from_path("User", int(user_id))
+
+            if author_key == user_key:
+                # Users always see their own post, re-render page with error
+                error = "Sorry, you cannot follow yourself."
+
+                self.render_home(error)
+                return
+
+            # If author is not in datastore, return 404
+            if not self.uow.get(author_key):
+                self.error(404)
+                return
+
+            # Follow is stored under the followed author, with the follower
+            # id as key name, so both are in the author's entity group
+            follow_key = db.Key.from_path("Follow", str(user_key.id()),
+                                          parent=author_key)
+
+            # Follow the author if not followed yet, otherwise unfollow them,
+            # and update the follower count, deciding inside the transaction
+            # so repeated clicks cannot count twice.  The author becomes
+            # popular once they have enough followers.
+            followed = []
+            promoted = []
+
+            def toggle_follow(follow, author):
+                del followed[:]
+                del promoted[:]
+                if follow:
+                    author.followers -= 1
+                    followed.append(False)
+                    return [follow.key()]
+
+                author.followers += 1
+                followed.append(True)
+                if (not author.popular and
+                        author.followers >= FANOUT_MAX_FOLLOWERS):
+                    author.popular = True
+                    promoted.append(author_key)
+                return [Follow(key=follow_key, follower=user_key.id())]
+
+            self.uow.update([follow_key, author_key], toggle_follow,
+                            optional=[follow_key])
+            self.uow.flush()
+
+            if followed == [False]:
+                def drop_popular(user):
+                    if author_key in user.popular_following:
+                        user.popular_following.remove(author_key)
+                self.uow.update(user_key, drop_popular)
+                self.uow.flush()
+
+                # Remove the author's post from the timeline in the
+                # background
+                taskqueue.add(url="/tasks/unfollow",
+                              params=dict(user=user_key.id(),
+                                          author=author_key.id()))
+            elif followed == [True]:
+                author = self.uow.get(author_key)
+
+                if author.popular:
+                    # Read the author's post on demand from now on
+                    def add_popular(user):
+                        if author_key not in user.popular_following:
+                            user.popular_following.append(author_key)
+                    self.uow.update(user_key, add_popular)
+                    self.uow.flush()
+
+                    # Tell the author's existing followers to do the same
+                    if promoted:
+                        taskqueue.add(url="/tasks/promote",
+                                      params=dict(author=author_key.id()))
+                else:
+                    # Add the author's recent post to the new follower's
+                    # timeline
+                    query = Post.all().ancestor(author_key)
+                    recent = query.order("-created").fetch(TIMELINE_SIZE)
+                    if recent:
+                        db.put([timeline_entries(post, [user_key])[0]
+                                for post in recent])
+
+            self.redirect("/timeline")
+
+
+class FanoutTask(Handler):
+    """Task queue handler writing a new blog post to the timelines of the
+        author and their followers, one batch of followers per task"""
+
+    def post(self):
+        post = db.get(db.Key(self.request.get("post")))
+        cursor = self.request.get("cursor")
+
+        # Post deleted before the task ran, nothing to fan out
+        if not post:
+            return
+
+        author_key = post.key().parent()
+        author = db.get(author_key)
+        if not cursor:
+            # Author always sees their own post
+            db.put(timeline_entries(post, [author_key]))
+            if not author or author.popular:
+                # Author is gone, or their followers fan out on read
+                return
+
+        # Follower user ids are the key names of the author's Follow children
+        query = Follow.all(keys_only=True).ancestor(author_key)
+        if cursor:
+            query.with_cursor(cursor)
+        follows = query.fetch(FANOUT_BATCH_SIZE)
+
+        followers = [db.Key.from_path("User", int(k.name())) for k in follows]
+        if followers:
+            db.put(timeline_entries(post, followers))
+
+        # Continue with the next batch of followers in a new task
+        if len(follows) == FANOUT_BATCH_SIZE:
+            taskqueue.add(url="/tasks/fanout",
+                          params=dict(post=str(post.key()),
+                                      cursor=query.cursor()))
+
+
+class UnfollowTask(Handler):
+    """Task queue handler removing an unfollowed author's post from a user's
+        timeline, one batch per task"""
+
+    def post(self):
+        user_key = db.Key.from_path("User", int(self.request.get("user")))
+        author_id = int(self.request.get("author"))
+
+        # Keep the entries if the user followed the author again meanwhile
+        follow_key = db.Key.from_path("User", author_id,
+                                      "Follow", str(user_key.id()))
+        if db.get(follow_key):
+            return
+
+        query = TimelineEntry.all(keys_only=True).ancestor(user_key)
+        entry_keys = query.filter("author =", author_id).fetch(MAX_BATCH_SIZE)
+        db.delete(entry_keys)
+
+        # Ancestor queries are strongly consistent, so the next task simply
+        # runs the query again
+        if len(entry_keys) == MAX_BATCH_SIZE:
+            taskqueue.add(url="/tasks/unfollow",
+                          params=dict(user=user_key.id(), author=author_id))
+
+
+class PromoteTask(Handler):
+    """Task queue handler adding a newly popular author to the
+        popular_following list of their followers, one batch per task"""
+
+    def post(self):
+        author_key = db.Key.from_path("User", int(self.request.get("author")))
+        cursor = self.request.get("cursor")
+
+        query = Follow.all(keys_only=True).ancestor(author_key)
+        if cursor:
+            query.with_cursor(cursor)
+        follows = query.fetch(PROMOTE_BATCH_SIZE)
+
+        # Each follower is its own entity group, so update them one at a time
+        for follow_key in follows:
+            user_key = db.Key.from_path("User", int(follow_key.name()))
+            uow = UnitOfWork()
+
+            def add_popular(user):
+                if author_key not in user.popular_following:
+                    user.popular_following.append(author_key)
+            uow.update(user_key, add_popular)
+            uow.flush()
+
+        # Continue with the next batch of followers in a new task
+        if len(follows) == PROMOTE_BATCH_SIZE:
+            taskqueue.add(url="/tasks/promote",
+                          params=dict(author=author_key.id(),
+                                      cursor=query.cursor()))
+
+
+class TrimTimelinesTask(Handler):
+    """Removes timeline entries older than TIMELINE_RETENTION, so timelines
+        do not grow without limit, one batch per task.  Started daily by
+        cron, see cron.yaml."""
+
+    def get(self):
+        taskqueue.add(url="/tasks/trim_timelines")
+        self.write("Trim started")
+
+    def post(self):
+        cutoff = datetime.datetime.now() - TIMELINE_RETENTION
+        query = TimelineEntry.all(keys_only=True).filter("created <", cutoff)
+        entry_keys = query.fetch(MAX_BATCH_SIZE)
+        db.delete(entry_keys)
+
+        # Continue with the next batch in a new task
+        if len(entry_keys) == MAX_BATCH_SIZE:
+            taskqueue.add(url="/tasks/trim_timelines")
+
+
+# - - - Export and Import Handlers - - - - - - - - - - - - - - - - - - -
+
+# Kinds included in a backup, in export order
+EXPORT_MODELS = collections.OrderedDict(
+    (model.kind(), model) for model in (User, Post, Comment, Like, Follow))
+EXPORT_BATCH_SIZE = 200
+EXPORT_BATCHES_PER_REQUEST = 25
+
+# String properties holding encoded keys, which embed the application id and
+# are exported as key paths instead
+KEY_STRING_PROPERTIES = dict(Post=["comments"])
+
+
+"""True for list properties holding datastore keys"""
+def is_key_list(prop):
+    return isinstance(prop, db.ListProperty) and prop.item_type is db.Key
+
+
+"""Convert an entity to a JSON-ready dict.  Keys are written as paths so
+    that they can be rebuilt under a different application id."""
+def entity_to_dict(entity):
+    kind = entity.kind()
+    data = dict(kind=kind, key=entity.key().to_path())
+    for name, prop in entity.properties().items():
+        value = prop.get_value_for_datastore(entity)
+        if name in KEY_STRING_PROPERTIES.get(kind, ()):
+            value = [db.Key(k).to_path() for k in value]
+        elif is_key_list(prop):
+            value = [k.to_path() for k in value]
+        elif isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        data[name] = value
+    return data
+
+
+"""Rebuild an entity from a dict made by entity_to_dict, keeping its
+    original key and therefore its parent"""
+def entity_from_dict(data):
+    kind = data["kind"]
+    model = EXPORT_MODELS[kind]
+    values = {}
+    for name, prop in model.properties().items():
+        if name not in data:
+            continue
+        value = data[name]
+        if name in KEY_STRING_PROPERTIES.get(kind, ()):
+            value = [str(db.Key.from_path(*path)) for path in value]
+        elif is_key_list(prop):
+            value = [db.Key.from_path(*path) for path in value]
+        elif isinstance(prop, db.DateTimeProperty) and value:
+            if "." in value:
+                fmt = "%Y-%m-%dT%H:%M:%S.%f"
+            else:
+                fmt = "%Y-%m-%dT%H:%M:%S"
+            value = datetime.datetime.strptime(value, fmt)
+        values[name] = value
+    return model(key=db.Key.from_path(*data["key"]), **values)
+
+
+class ExportPage(Handler):
+    """Exports every blog kind as newline-delimited JSON.  Each response
+        holds a bounded number of batches; while data remains, the
+        X-Export-Kind and X-Export-Cursor headers give the parameters for
+        the next request.  Restricted to administrators in app.yaml."""
+
+    def get(self):
+        kinds = list(EXPORT_MODELS)
+        kind = self.request.get("kind") or kinds[0]
+        if kind not in EXPORT_MODELS:
+            self.error(400)
+            return
+
+        query = EXPORT_MODELS[kind].all()
+        cursor = self.request.get("cursor")
+        if cursor:
+            try:
+                query.with_cursor(cursor)
+            except db.BadValueError:
+                self.error(400)
+                return
+
+        self.response.headers["Content-Type"] = "application/x-ndjson"
+        for i in xrange(EXPORT_BATCHES_PER_REQUEST):
+            # Write each batch out before fetching the next
+            batch = query.fetch(EXPORT_BATCH_SIZE)
+            for entity in batch:
+                self.write(json.dumps(entity_to_dict(entity)) + "\n")
+
+            if len(batch) < EXPORT_BATCH_SIZE:
+                # Kind finished, continue with the next one if any
+                index = kinds.index(kind) + 1
+                if index < len(kinds):
+                    self.response.headers["X-Export-Kind"] = kinds[index]
+                return
+            query.with_cursor(query.cursor())
+
+        # Batch budget used up, resume this kind from the cursor
+        self.response.headers["X-Export-Kind"] = kind
+        self.response.headers["X-Export-Cursor"] = str(query.cursor())
+
+
+"""Reserve the numeric ids of imported keys, so that the datastore never
+    allocates one of them to a new entity and overwrites the imported one.
+    Reserving an id reserves every lower id of the same kind and parent, so
+    only the highest id of each is sent, all in concurrent RPCs."""
+def reserve_ids(keys):
+    highest = {}
+    for key in keys:
+        if key.id() is not None:
+            template = db.Key.from_path(key.kind(), 1, parent=key.parent())
+            name = str(template)
+            if name not in highest or highest[name][1] < key.id():
+                highest[name] = (template, key.id())
+
+    rpcs = [datastore.AllocateIdsAsync(template, max=max_id)
+            for template, max_id in highest.values()]
+    for rpc in rpcs:
+        rpc.get_result()
+
+
+class ImportPage(Handler):
+    """Imports newline-delimited JSON made by ExportPage, writing entities
+        under their original keys in batched puts.  Numeric ids are reserved
+        before each put.  Importing the same data twice overwrites rather
+        than duplicates it, so a failed import can be retried.  Restricted
+        to administrators in app.yaml."""
+
+    def post(self):
+        count = 0
+        batch = []
+        for line in self.request.body_file:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                batch.append(entity_from_dict(json.loads(line)))
+            except (ValueError, KeyError, TypeError, db.Error):
+                # Report the bad line, earlier batches stay written
+                self.error(400)
+                self.write("Invalid entity after %d imported" % count)
+                return
+
+            if len(batch) == MAX_BATCH_SIZE:
+                count += self.put_batch(batch)
+                batch = []
+
+        count += self.put_batch(batch)
+        self.write("Imported %d entities" % count)
+
+    """Write a batch of imported entities and drop any cached copies"""
+    def put_batch(self, batch):
+        if batch:
+            reserve_ids([entity.key() for entity in batch])
+            invalidate(*db.put(batch))
+        return len(batch)
+
+
+# - - - Warmup Handler - - - - - - - - - - - - - - - - - - -
+
+class WarmupHandler(Handler):
+    """Receives the warmup request App Engine sends to a new instance before
+        routing user traffic to it, so the first user request does not pay
+        for compiling templates or opening datastore and memcache RPCs"""
+
+    def get(self):
+        # Load and compile every template into the jinja environment cache
+        for template in jinja_env.list_templates():
+            jinja_env.get_template(template)
+
+        # Query the front-page feed, which opens the datastore and memcache
+        # RPC channels and fills the instance cache and version counters
+        front_page()
+
+        self.write("OK")
+
+
+# - - - Cache Statistics Handler - - - - - - - - - - - - - - - - - - -
+
+class CacheStatsPage(Handler):
+    """Reports hit-rate and eviction statistics for this instance's entity
+        cache as JSON.  Restricted to administrators in app.yaml."""
+
+    def get(self):
+        self.response.headers["Content-Type"] = "application/json"
+        self.write(json.dumps(entity_cache.stats()))
+
+
 # - - - URL Mapping - - - - - - - - - - - - - - - - - - -
 
 app = webapp2.WSGIApplication(
@@ -848,5 +2105,19 @@ app = webapp2.WSGIApplication(
      ("/like/([\S]+)", LikeHandler),
      ("/comment/([\S]+)", CommentPage),
      ("/editcomment/([\S]+)", EditComment),
-     ("/deletecomment/([\S]+)", DeleteComment)
+     ("/deletecomment/([\S]+)", DeleteComment),
+     ("/trending", TrendingPage),
+     ("/timeline", TimelinePage),
+     ("/user/([a-zA-Z0-9_-]+)", ProfilePage),
+     ("/follow/([0-9]+)", FollowHandler),
+     ("/tasks/trending", TrendingJob),
+     ("/tasks/fanout", FanoutTask),
+     ("/tasks/unfollow", UnfollowTask),
+     ("/tasks/promote", PromoteTask),
+     ("/tasks/trim_timelines", TrimTimelinesTask),
+     ("/tasks/recount_stats", RecountStatsTask),
+     ("/admin/export", ExportPage),
+     ("/admin/import", ImportPage),
+     ("/_ah/warmup", WarmupHandler),
+     ("/_stats/cache", CacheStatsPage)
      ], debug=True)
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""Tests for the memcache token bucket rate limiter in main.py.
+
+Run with the App Engine SDK on the path, from the project directory:
+    python -m unittest discover -p "test_*.py"
+"""
+import unittest
+
+# Put the SDK's bundled libraries (webapp2, jinja2, ...) on the path
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+import webapp2
+from google.appengine.ext import testbed
+
+import main
+
+
+class FakeClock(object):
+    """Stands in for the time module in main so tests control the clock"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class BrokenClient(object):
+    """Memcache client behaving as if memcache were unavailable"""
+
+    def gets(self, key):
+        return None
+
+    def add(self, key, value, time=0):
+        return False
+
+    def cas(self, key, value, time=0):
+        return False
+
+
+class ThrottledHandler(main.Handler):
+    @main.rate_limited("test", dict(user=(2, 60), post=(3, 60)))
+    def post(self, web_safe_post_key):
+        self.write("OK")
+
+
+app = webapp2.WSGIApplication([(r"/throttled/([\S]+)", ThrottledHandler)])
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_datastore_v3_stub()
+
+        self.clock = FakeClock(1000.0)
+        self.real_time = main.time
+        self.real_client = main.memcache.Client
+        main.time = self.clock
+
+    def tearDown(self):
+        main.time = self.real_time
+        main.memcache.Client = self.real_client
+        self.testbed.deactivate()
+
+    """Post to the throttled handler as the given user"""
+    def post(self, user_id, post_key):
+        request = webapp2.Request.blank("/throttled/%s" % post_key, POST={})
+        request.headers["Cookie"] = "user_id=%s" % main.make_secure_val(
+            str(user_id))
+        return request.get_response(app)
+
+    def test_allows_up_to_limit(self):
+        for i in range(3):
+            self.assertEqual(main.take_token("bucket", 3, 60), 0)
+        self.assertTrue(main.take_token("bucket", 3, 60) > 0)
+
+    def test_refills_continuously(self):
+        for i in range(3):
+            main.take_token("bucket", 3, 60)
+
+        # One token comes back every 20 seconds
+        self.assertEqual(main.take_token("bucket", 3, 60), 20)
+        self.clock.now += 20
+        self.assertEqual(main.take_token("bucket", 3, 60), 0)
+        self.assertTrue(main.take_token("bucket", 3, 60) > 0)
+
+    def test_burst_never_exceeds_limit(self):
+        # An idle bucket holds no more than limit tokens
+        self.clock.now += 3600
+        allowed = [main.take_token("bucket", 3, 60) == 0 for i in range(5)]
+        self.assertEqual(allowed, [True, True, True, False, False])
+
+    def test_handler_allows_then_denies_with_429(self):
+        self.assertEqual(self.post(1, "a").status_int, 200)
+        self.assertEqual(self.post(1, "a").status_int, 200)
+
+        response = self.post(1, "a")
+        self.assertEqual(response.status_int, 429)
+        self.assertEqual(response.headers["Retry-After"], "30")
+
+    def test_user_bucket_covers_every_post(self):
+        self.post(1, "a")
+        self.post(1, "b")
+        self.assertEqual(self.post(1, "c").status_int, 429)
+        self.assertEqual(self.post(2, "c").status_int, 200)
+
+    def test_post_bucket_covers_every_user(self):
+        for user_id in (1, 2, 3):
+            self.assertEqual(self.post(user_id, "a").status_int, 200)
+        self.assertEqual(self.post(4, "a").status_int, 429)
+        self.assertEqual(self.post(4, "b").status_int, 200)
+
+    def test_signed_out_requests_are_not_throttled(self):
+        request = webapp2.Request.blank("/throttled/a", POST={})
+        for i in range(5):
+            self.assertEqual(request.get_response(app).status_int, 200)
+
+    def test_memcache_failure_lets_requests_through(self):
+        main.memcache.Client = BrokenClient
+        for i in range(5):
+            self.assertEqual(self.post(1, "a").status_int, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()